@@ -0,0 +1,102 @@
+# freshness tracking for scraped links, decides what to re-check and does the conditional GETs
+
+import hashlib
+from datetime import datetime, timedelta
+from math import log1p
+from os import getenv
+from dotenv import load_dotenv
+from parse_worker import read_limited, declared_charset
+
+load_dotenv()
+
+# Don't re-check a link more often than this
+REFRESH_MIN_AGE_HOURS = float(getenv("REFRESH_MIN_AGE_HOURS") or 24)
+# Most links one /refresh call may re-check
+REFRESH_MAX_LIMIT = 50
+# How many of the longest unchecked links get scored per picked link
+REFRESH_CANDIDATES = 5
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+
+
+def content_hash(text: str):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def new_freshness(headers, text: str):
+    """Freshness record stored on a scrape right after it was fetched"""
+    now = datetime.now()
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'content_hash': content_hash(text),
+        'checked_at': now,
+        'changed_at': now,
+        'checks': 0,
+        'changes': 0,
+        'hits': 0
+    }
+
+
+def conditional_headers(freshness: dict):
+    headers = dict(HEADERS)
+    if freshness.get('etag'):
+        headers['If-None-Match'] = freshness['etag']
+    if freshness.get('last_modified'):
+        headers['If-Modified-Since'] = freshness['last_modified']
+    return headers
+
+
+def priority(doc: dict, now: datetime):
+    """Higher means re-check sooner: older, more viewed and more often changed links win"""
+    freshness = doc.get('freshness', {})
+    checked_at = freshness.get('checked_at') or doc.get('timestamp') or now
+    age_hours = (now - checked_at).total_seconds() / 3600
+    if age_hours < REFRESH_MIN_AGE_HOURS:
+        return 0
+
+    # Smoothed so links with no history still get a fair chance
+    change_rate = (freshness.get('changes', 0) + 1) / \
+        (freshness.get('checks', 0) + 2)
+
+    return (age_hours / REFRESH_MIN_AGE_HOURS) * \
+        (1 + log1p(freshness.get('hits', 0))) * (0.5 + change_rate)
+
+
+def ensure_indexes(collection):
+    collection.create_index('freshness.checked_at')
+
+
+def stale_links(collection, limit: int):
+    now = datetime.now()
+    cutoff = now - timedelta(hours=REFRESH_MIN_AGE_HOURS)
+    # Scrapes from before freshness tracking only have their timestamp
+    docs = collection.find(
+        {
+            'url': {'$exists': True},
+            '$or': [
+                {'freshness.checked_at': {'$lt': cutoff}},
+                {'freshness.checked_at': {'$exists': False},
+                    'timestamp': {'$lt': cutoff}}
+            ]
+        },
+        {'url': 1, 'timestamp': 1, 'preferences': 1, 'freshness': 1}
+    ).sort('freshness.checked_at', 1).limit(limit * REFRESH_CANDIDATES)
+
+    scored = [(priority(doc, now), doc) for doc in docs]
+    scored = [item for item in scored if item[0] > 0]
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return [doc for _, doc in scored[:limit]]
+
+
+async def conditional_get(session, url: str, freshness: dict):
+    """Returns (status, body, encoding, headers), body is None when the page wasn't modified"""
+    async with session.get(url, headers=conditional_headers(freshness)) as response:
+        if response.status == 304:
+            return 304, None, None, response.headers
+        response.raise_for_status()
+        # Same charset rule as /scrape so unchanged pages hash the same
+        raw = await read_limited(response)
+        return response.status, raw, declared_charset(response.headers.get('Content-Type')), response.headers
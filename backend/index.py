@@ -1,8 +1,6 @@
 # fast api server with a get endpoint to take a link and scrape the text from the page
 
-from fastapi import FastAPI, HTTPException
-import requests
-from bs4 import BeautifulSoup
+from fastapi import FastAPI, HTTPException, Header, Query
 from datetime import datetime
 import json
 from phi.agent import Agent
@@ -19,13 +17,22 @@ from phi.embedder.openai import OpenAIEmbedder
 from phi.document import Document
 from os import getenv
 import aiohttp
+import asyncio
+from contextlib import asynccontextmanager
 from bson import ObjectId
+from parse_worker import parse_html, get_pool, shutdown_pool, read_limited, declared_charset
+from freshness import new_freshness, stale_links, conditional_get, content_hash, ensure_indexes, REFRESH_MAX_LIMIT
+from hmac import compare_digest
+from hashlib import md5
+from uuid import UUID
+from qdrant_client import models
 
 load_dotenv()
 
 QD_API_KEY = getenv("QDRANT_API_KEY")
 QD_URL = getenv("QDRANT_URL")
 OPENAI_API_KEY = getenv("ORIGINAL_OPENAI_API_KEY")
+CRON_SECRET = getenv("CRON_SECRET")
 
 vector_db = Qdrant(
     collection="linkbender",
@@ -149,7 +156,19 @@ talking_agent = Agent(
     """]
 )
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_pool()
+    try:
+        await asyncio.to_thread(ensure_indexes, collection)
+    except Exception as e:
+        print(f"Failed to create indexes: {e}")
+    yield
+    shutdown_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -171,6 +190,22 @@ collection = db['scrapes']
 tags_collection = db['tags']
 
 
+async def fetch_page(url: str):
+    """Download a page without blocking, returns the raw body, its declared charset and the headers"""
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    }
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"Failed to access URL: {response.status}"
+                )
+            raw = await read_limited(response)
+            return raw, declared_charset(response.headers.get('Content-Type')), response.headers
+
+
 @app.get("/talk")
 async def talk(query: str):
     response = talking_agent.run(query)
@@ -208,6 +243,7 @@ async def talk(query: str):
 
 @ app.get("/scrape")
 async def scrape(url: str):
+    text = ""
     try:
         # Validate URL
         if not url:
@@ -220,36 +256,19 @@ async def scrape(url: str):
 
         # Check if URL is accessible
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        raise HTTPException(
-                            status_code=422,
-                            detail=f"Failed to access URL: {response.status}"
-                        )
-                    text = await response.text()
+            raw, encoding, page_headers = await fetch_page(url)
         except Exception as e:
             raise HTTPException(
                 status_code=422,
                 detail=f"Failed to fetch URL: {str(e)}"
             )
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        for script in soup(["script", "style"]):
-            script.decompose()
-
-        text = ' '.join(line.strip()
-                        for line in soup.get_text().splitlines() if line.strip())
+        # Parse in the worker pool so big pages don't block other requests
+        parsed = await parse_html(raw, encoding)
+        text = parsed['text']
 
         # Simplified agent response handling
-        agent_response = summary_agent.run(text)
+        agent_response = await asyncio.to_thread(summary_agent.run, text)
 
         # Clean and parse the response
         try:
@@ -316,6 +335,11 @@ async def scrape(url: str):
                 'summary': response_data['summary'],
                 'grade': response_data['grade'],
                 'badge': response_data['badge'],
+                'tags': [tag.lower().strip() for tag in response_data['tags']],
+                'title': parsed['title'],
+                'language': parsed['language'],
+                'word_count': parsed['word_count'],
+                'freshness': new_freshness(page_headers, text),
                 'timestamp': datetime.now(),
                 'content': text[:1000]
             }
@@ -349,7 +373,7 @@ async def scrape(url: str):
                 }
             }
 
-    except requests.RequestException as e:
+    except aiohttp.ClientError as e:
         return {
             "status": "error",
             "error": f"Failed to fetch URL: {str(e)}",
@@ -519,7 +543,7 @@ async def get_cached(url: str):
         doc = collection.find_one(
             {'url': normalized_url},
             {
-                '_id': 0,
+                '_id': 1,  # Needed to count the view on this exact doc
                 'url': 1,
                 'summary': 1,
                 'tags': 1,
@@ -536,6 +560,12 @@ async def get_cached(url: str):
                 "error": "URL not found in cache"
             }
 
+        # Views make a link more worth keeping fresh
+        collection.update_one(
+            {'_id': doc['_id']},
+            {'$inc': {'freshness.hits': 1}}
+        )
+
         # Format the response with all fields
         return {
             "status": "success",
@@ -607,19 +637,11 @@ async def get_custom_summary(
             url = f"https://{url}"
 
         # Fetch and parse content (reusing existing logic)
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        raw, encoding, page_headers = await fetch_page(url)
 
-        soup = BeautifulSoup(response.text, 'html.parser')
-        for script in soup(["script", "style"]):
-            script.decompose()
-
-        text = ' '.join(line.strip()
-                        for line in soup.get_text().splitlines() if line.strip())
+        # Parse in the worker pool so big pages don't block other requests
+        parsed = await parse_html(raw, encoding)
+        text = parsed['text']
 
         # Add preferences to the text for the agent
         context = f"""
@@ -632,7 +654,7 @@ async def get_custom_summary(
         """
 
         # Get custom summary
-        agent_response = custom_summary_agent.run(context)
+        agent_response = await asyncio.to_thread(custom_summary_agent.run, context)
 
         # Process response (similar to existing logic)
         if isinstance(agent_response.content, dict):
@@ -657,6 +679,10 @@ async def get_custom_summary(
                 'length': length,
                 'style': style
             },
+            'title': parsed['title'],
+            'language': parsed['language'],
+            'word_count': parsed['word_count'],
+            'freshness': new_freshness(page_headers, text),
             'timestamp': datetime.now(),
             'content': text[:1000]  # Store first 1000 chars
         }
@@ -682,3 +708,198 @@ async def get_custom_summary(
                 "badge": "none"
             }
         }
+
+
+def parse_agent_content(content):
+    if isinstance(content, dict):
+        return content
+    clean_response = (
+        content
+        .replace('```json', '')
+        .replace('```', '')
+        .strip()
+    )
+    return json.loads(clean_response)
+
+
+def update_tag_counts(old_tags, new_tags):
+    new_tags = set(tag.lower().strip() for tag in new_tags)
+    if old_tags is None:
+        # Older scrapes didn't store their tags, so only add the ones that are missing
+        for tag in new_tags:
+            tags_collection.update_one(
+                {'name': tag},
+                {'$setOnInsert': {'count': 1, 'created_at': datetime.now()}},
+                upsert=True
+            )
+        return
+
+    old_tags = set(tag.lower().strip() for tag in old_tags)
+    for tag in old_tags - new_tags:
+        tags_collection.update_one({'name': tag}, {'$inc': {'count': -1}})
+    for tag in new_tags - old_tags:
+        tags_collection.update_one(
+            {'name': tag},
+            {'$inc': {'count': 1}, '$setOnInsert': {'created_at': datetime.now()}},
+            upsert=True
+        )
+
+
+def save_tags(doc_id, new_tags, count=True):
+    # Swap the stored tags and diff against what was there in one step,
+    # so running this again after a failure can't count the same tags twice
+    before = collection.find_one_and_update(
+        {'_id': doc_id},
+        {'$set': {'tags': new_tags}},
+        projection={'tags': 1}
+    )
+    if count:
+        update_tag_counts(before.get('tags'), new_tags)
+
+
+def replace_vector(doc_id, response_data):
+    content = f"{response_data['summary']} {', '.join(response_data['tags'])} {response_data['grade']} {response_data['badge']}"
+    vector_db.insert([Document(
+        content=content,
+        name=doc_id,
+        meta_data=response_data
+    )])
+
+    # Qdrant ids phi derives from the content, anything else under this name is the old version
+    point_id = str(UUID(md5(content.replace("\x00", "\ufffd").encode()).hexdigest()))
+    vector_db.client.delete(
+        collection_name=vector_db.collection,
+        points_selector=models.FilterSelector(
+            filter=models.Filter(
+                must=[
+                    models.FieldCondition(
+                        key="name", match=models.MatchValue(value=doc_id))
+                ],
+                must_not=[models.HasIdCondition(has_id=[point_id])]
+            )
+        )
+    )
+
+
+async def refresh_link(session, doc):
+    url = doc['url']
+    freshness = doc.get('freshness', {})
+    now = datetime.now()
+    updates = {'freshness.checked_at': now}
+    counters = {'freshness.checks': 1}
+
+    status, raw, encoding, headers = await conditional_get(session, url, freshness)
+    if status == 304:
+        collection.update_one({'_id': doc['_id']}, {
+                              '$set': updates, '$inc': counters})
+        return "not_modified"
+
+    parsed = await parse_html(raw, encoding)
+    text = parsed['text']
+    new_hash = content_hash(text)
+
+    # Scrapes from before freshness tracking were decoded differently and only
+    # kept 1000 chars, so the first check just records the hash to compare against
+    old_hash = freshness.get('content_hash')
+    if new_hash == old_hash or not old_hash:
+        updates.update({
+            'freshness.etag': headers.get('ETag'),
+            'freshness.last_modified': headers.get('Last-Modified'),
+            'freshness.content_hash': new_hash
+        })
+        collection.update_one({'_id': doc['_id']}, {
+                              '$set': updates, '$inc': counters})
+        return "unchanged" if old_hash else "recorded"
+
+    preferences = doc.get('preferences')
+    if preferences:
+        context = f"""
+        PREFERENCES:
+        Length: {preferences['length']}
+        Style: {preferences['style']}
+
+        CONTENT:
+        {text}
+        """
+        agent_response = await asyncio.to_thread(custom_summary_agent.run, context)
+    else:
+        agent_response = await asyncio.to_thread(summary_agent.run, text)
+
+    response_data = parse_agent_content(agent_response.content)
+    response_data = {
+        "summary": str(response_data.get("summary", "No summary available")),
+        # Normalized like /scrape so tag search and the tags collection match
+        "tags": [str(tag).lower().strip() for tag in response_data.get("tags", ["error"])],
+        "grade": str(response_data.get("grade", "error")),
+        "badge": str(response_data.get("badge", "error"))
+    }
+
+    # Only /scrape results are in the vector db and the tag counts
+    if not preferences:
+        await asyncio.to_thread(replace_vector, str(doc['_id']), response_data)
+    await asyncio.to_thread(save_tags, doc['_id'], response_data['tags'], not preferences)
+
+    # Written last so a failed vector swap gets picked up again on the next refresh
+    updates.update({
+        'summary': response_data['summary'],
+        'grade': response_data['grade'],
+        'badge': response_data['badge'],
+        'title': parsed['title'],
+        'language': parsed['language'],
+        'word_count': parsed['word_count'],
+        'content': text[:1000],
+        'freshness.etag': headers.get('ETag'),
+        'freshness.last_modified': headers.get('Last-Modified'),
+        'freshness.content_hash': new_hash,
+        'freshness.changed_at': now
+    })
+    counters['freshness.changes'] = 1
+    collection.update_one({'_id': doc['_id']}, {
+                          '$set': updates, '$inc': counters})
+
+    return "changed"
+
+
+# Vercel cron calls this with GET and "Authorization: Bearer $CRON_SECRET"
+@ app.api_route("/refresh", methods=["GET", "POST"])
+async def refresh(
+    limit: int = Query(20, ge=1, le=REFRESH_MAX_LIMIT),
+    authorization: str = Header(None)
+):
+    if not CRON_SECRET or not compare_digest(authorization or "", f"Bearer {CRON_SECRET}"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    try:
+        docs = await asyncio.to_thread(stale_links, collection, limit)
+        semaphore = asyncio.Semaphore(5)
+
+        async with aiohttp.ClientSession() as session:
+            async def run(doc):
+                async with semaphore:
+                    try:
+                        return await refresh_link(session, doc)
+                    except Exception as e:
+                        print(f"Failed to refresh {doc['url']}: {e}")
+                        # Still count the check so dead links don't stay at the front
+                        collection.update_one({'_id': doc['_id']}, {
+                            '$set': {'freshness.checked_at': datetime.now()},
+                            '$inc': {'freshness.checks': 1}
+                        })
+                        return "error"
+
+            results = await asyncio.gather(*(run(doc) for doc in docs))
+
+        return {
+            "status": "success",
+            "checked": len(docs),
+            "results": [
+                {"url": doc['url'], "result": result}
+                for doc, result in zip(docs, results)
+            ],
+            "changed": results.count("changed")
+        }
+    except Exception as e:
+        return {
+            "status": "error",
+            "error": str(e)
+        }
@@ -0,0 +1,180 @@
+# process pool for the cpu bound html parsing, keeps BeautifulSoup off the event loop
+
+import asyncio
+import multiprocessing
+import signal
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import cpu_count, getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 0 turns the pool off and parses in a thread instead
+PARSE_WORKERS = int(getenv("PARSE_WORKERS") or cpu_count() or 2)
+PARSE_MAX_BYTES = int(getenv("PARSE_MAX_BYTES") or 5 * 1024 * 1024)
+PARSE_TIMEOUT = float(getenv("PARSE_TIMEOUT") or 10)
+# Threads can't be killed, so pages parsed without the pool get a much smaller cap
+PARSE_THREAD_MAX_BYTES = int(
+    getenv("PARSE_THREAD_MAX_BYTES") or 1024 * 1024)
+# Extra time the in-worker alarm gets before the worker is killed
+PARSE_GRACE = 2
+
+_pool = None
+_pool_unavailable = False
+# Pools killed on purpose, their other tasks are safe to retry
+_killed_pools = weakref.WeakSet()
+
+
+class ParseTimeout(Exception):
+    pass
+
+
+def _warm_worker():
+    # Import the parser once per worker so the first task doesn't pay for it
+    import bs4  # noqa: F401
+
+    signal.signal(signal.SIGALRM, _on_timeout)
+
+
+def _on_timeout(signum, frame):
+    raise ParseTimeout()
+
+
+def _parse(raw, encoding, timeout):
+    from bs4 import BeautifulSoup
+
+    # Kill the task inside the worker so the process can be reused,
+    # threads can't use the alarm so they rely on the caller's timeout
+    if timeout:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        soup = BeautifulSoup(raw, 'html.parser', from_encoding=encoding)
+        for script in soup(["script", "style"]):
+            script.decompose()
+
+        title = soup.title.get_text(strip=True) if soup.title else ""
+        language = soup.html.get("lang", "") if soup.html else ""
+
+        text = ' '.join(line.strip()
+                        for line in soup.get_text().splitlines() if line.strip())
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    return {
+        "text": text,
+        "title": title,
+        "language": language.split("-")[0].lower() if isinstance(language, str) else "",
+        "word_count": len(text.split())
+    }
+
+
+def declared_charset(content_type):
+    """Charset from a Content-Type header, None when the server didn't declare one"""
+    for param in (content_type or "").split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset" and value.strip('"\' '):
+            return value.strip('"\' ')
+    return None
+
+
+async def read_limited(response):
+    """Read an aiohttp response body, giving up once it's over PARSE_MAX_BYTES"""
+    if (response.content_length or 0) > PARSE_MAX_BYTES:
+        raise ValueError(
+            f"Page is too large to parse: {response.content_length} bytes (limit {PARSE_MAX_BYTES})")
+
+    chunks = []
+    size = 0
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        size += len(chunk)
+        if size > PARSE_MAX_BYTES:
+            raise ValueError(
+                f"Page is too large to parse: over {PARSE_MAX_BYTES} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def get_pool():
+    """The shared worker pool, None when parsing should happen in a thread"""
+    global _pool, _pool_unavailable
+    if _pool is None and PARSE_WORKERS > 0 and not _pool_unavailable:
+        try:
+            # Forking would copy the pymongo and request threads' locks into the workers
+            pool = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_worker
+            )
+            # Start every worker now instead of on the first requests
+            for _ in range(PARSE_WORKERS):
+                pool.submit(int)
+        except (OSError, NotImplementedError, ImportError) as e:
+            # Serverless runtimes often lack the semaphores multiprocessing needs
+            print(f"Parse worker pool unavailable, parsing in threads: {e}")
+            _pool_unavailable = True
+        else:
+            _pool = pool
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _recycle_pool(pool, kill=True):
+    # A worker that ignored its alarm is stuck, the only way out is to kill it.
+    # Leave the pool alone if another request already replaced it
+    global _pool
+    if pool is not _pool:
+        return
+    _pool = None
+    if kill:
+        _killed_pools.add(pool)
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def parse_html(raw: bytes, encoding: str = None):
+    """Extract text, title, language and word count from raw html bytes in the worker pool"""
+    if len(raw) > PARSE_MAX_BYTES:
+        raise ValueError(
+            f"Page is too large to parse: {len(raw)} bytes (limit {PARSE_MAX_BYTES})")
+
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = get_pool()
+        if pool is None:
+            if len(raw) > PARSE_THREAD_MAX_BYTES:
+                raise ValueError(
+                    f"Page is too large to parse without workers: {len(raw)} bytes (limit {PARSE_THREAD_MAX_BYTES})")
+            # The timeout only frees the request, the thread finishes the parse
+            return await asyncio.wait_for(
+                asyncio.to_thread(_parse, raw, encoding, None),
+                timeout=PARSE_TIMEOUT
+            )
+
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(
+                    pool, _parse, raw, encoding, PARSE_TIMEOUT),
+                timeout=PARSE_TIMEOUT + PARSE_GRACE
+            )
+        except ParseTimeout:
+            raise TimeoutError("Parsing took too long")
+        except asyncio.TimeoutError:
+            _recycle_pool(pool)
+            raise TimeoutError("Parsing took too long")
+        except BrokenProcessPool:
+            # Another task's worker was killed on purpose, try once more on a fresh pool.
+            # Otherwise this page may have crashed the worker itself, don't feed it to another
+            if pool in _killed_pools and not attempt:
+                continue
+            _recycle_pool(pool, kill=False)
+            raise
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+import freshness
+
+NOW = datetime(2024, 11, 20, 12, 0)
+
+
+def hours_ago(hours):
+    return NOW - timedelta(hours=hours)
+
+
+def test_content_hash_is_stable():
+    assert freshness.content_hash("page") == freshness.content_hash("page")
+    assert freshness.content_hash("page") != freshness.content_hash("page!")
+
+
+def test_new_freshness():
+    record = freshness.new_freshness(
+        {'ETag': '"abc"', 'Last-Modified': 'Wed, 20 Nov 2024 10:00:00 GMT'}, "page")
+
+    assert record['etag'] == '"abc"'
+    assert record['last_modified'] == 'Wed, 20 Nov 2024 10:00:00 GMT'
+    assert record['content_hash'] == freshness.content_hash("page")
+    assert record['checked_at'] == record['changed_at']
+    assert (record['checks'], record['changes'], record['hits']) == (0, 0, 0)
+
+
+def test_new_freshness_without_validators():
+    record = freshness.new_freshness({}, "page")
+
+    assert record['etag'] is None
+    assert record['last_modified'] is None
+
+
+def test_conditional_headers():
+    headers = freshness.conditional_headers({
+        'etag': '"abc"',
+        'last_modified': 'Wed, 20 Nov 2024 10:00:00 GMT'
+    })
+
+    assert headers['If-None-Match'] == '"abc"'
+    assert headers['If-Modified-Since'] == 'Wed, 20 Nov 2024 10:00:00 GMT'
+    assert headers['User-Agent'] == freshness.HEADERS['User-Agent']
+
+
+def test_conditional_headers_skip_missing_validators():
+    headers = freshness.conditional_headers({'etag': None})
+
+    assert 'If-None-Match' not in headers
+    assert 'If-Modified-Since' not in headers
+
+
+def test_priority_skips_recently_checked():
+    doc = {'freshness': {'checked_at': hours_ago(1)}}
+
+    assert freshness.priority(doc, NOW) == 0
+
+
+def test_priority_uses_timestamp_for_old_scrapes():
+    assert freshness.priority({'timestamp': hours_ago(48)}, NOW) > 0
+
+
+def test_priority_prefers_older_viewed_and_changing_links():
+    base = {'checked_at': hours_ago(48), 'checks': 4, 'changes': 0, 'hits': 0}
+
+    older = {**base, 'checked_at': hours_ago(96)}
+    viewed = {**base, 'hits': 20}
+    changing = {**base, 'changes': 4}
+
+    plain = freshness.priority({'freshness': base}, NOW)
+    assert freshness.priority({'freshness': older}, NOW) > plain
+    assert freshness.priority({'freshness': viewed}, NOW) > plain
+    assert freshness.priority({'freshness': changing}, NOW) > plain
+
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        self.sorted_by = (key, direction)
+        return self
+
+    def limit(self, count):
+        self.limited_to = count
+        return FakeCursor(self[:count])
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection):
+        self.query = query
+        self.projection = projection
+        return FakeCursor(self.docs)
+
+
+def test_stale_links_filters_in_query():
+    collection = FakeCollection([])
+
+    freshness.stale_links(collection, 10)
+
+    checked, legacy = collection.query['$or']
+    assert '$lt' in checked['freshness.checked_at']
+    assert legacy['freshness.checked_at'] == {'$exists': False}
+    assert '$lt' in legacy['timestamp']
+    assert 'content' not in collection.projection
+
+
+def test_stale_links_orders_by_priority():
+    now = datetime.now()
+    collection = FakeCollection([
+        {'url': 'old', 'timestamp': now - timedelta(hours=48)},
+        {'url': 'popular', 'freshness': {
+            'checked_at': now - timedelta(hours=30), 'hits': 50, 'checks': 2, 'changes': 2}},
+        {'url': 'quiet', 'freshness': {
+            'checked_at': now - timedelta(hours=30), 'checks': 10, 'changes': 0}},
+    ])
+
+    assert [doc['url'] for doc in freshness.stale_links(collection, 2)] == [
+        'popular', 'old']
@@ -0,0 +1,217 @@
+import asyncio
+import os
+import signal
+import time
+
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+
+import parse_worker
+
+PAGE = """
+<html lang="en-US">
+    <head>
+        <title> Linkbender </title>
+        <style>body { color: red; }</style>
+        <script>var hidden = true;</script>
+    </head>
+    <body>
+        <h1>Hello</h1>
+        <p>  one two  </p>
+
+        <p>three</p>
+    </body>
+</html>
+""".encode()
+
+real_parse = parse_worker._parse
+
+
+def fake_parse(raw, encoding, timeout):
+    # Stands in for pages that hang or crash the worker: b"<command>|<marker path>|<html>"
+    command, path, html = raw.split(b"|", 2)
+    path = path.decode()
+    with open(path + ".started", "a") as marker:
+        marker.write("x")
+    if command == b"hang":
+        time.sleep(60)
+    if command == b"crash":
+        os._exit(1)
+    if command == b"wait":
+        # Hold the worker until the test says so
+        while not os.path.exists(path + ".release"):
+            time.sleep(0.01)
+    return real_parse(html, encoding, timeout)
+
+
+async def wait_for_file(path, content=None):
+    while not os.path.exists(path) or (content and open(path).read() != content):
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def pool_state(monkeypatch):
+    monkeypatch.setattr(parse_worker, "_pool", None)
+    monkeypatch.setattr(parse_worker, "_pool_unavailable", False)
+    yield
+    pool = parse_worker._pool
+    if pool is not None:
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+        parse_worker.shutdown_pool()
+
+
+def test_parse_extracts_text_and_metadata():
+    parsed = real_parse(PAGE, None, None)
+
+    assert parsed == {
+        "text": "Linkbender Hello one two three",
+        "title": "Linkbender",
+        "language": "en",
+        "word_count": 5
+    }
+
+
+def test_parse_without_html_tag():
+    parsed = real_parse(b"just some text", None, None)
+
+    assert parsed["text"] == "just some text"
+    assert parsed["title"] == ""
+    assert parsed["language"] == ""
+
+
+def test_parse_detects_encoding_from_meta():
+    raw = '<html><head><meta charset="utf-8"></head><body>café</body></html>'.encode()
+
+    assert real_parse(raw, None, None)["text"] == "café"
+
+
+def test_parse_alarm_stops_slow_parse():
+    previous = signal.signal(signal.SIGALRM, parse_worker._on_timeout)
+    try:
+        with pytest.raises(parse_worker.ParseTimeout):
+            real_parse(b"<p>x</p>" * 200000, None, 0.01)
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+
+
+@pytest.mark.parametrize("content_type, charset", [
+    ("text/html; charset=UTF-8", "UTF-8"),
+    ('text/html; Charset="iso-8859-1"', "iso-8859-1"),
+    ("text/html", None),
+    ("text/html; charset=", None),
+    (None, None),
+])
+def test_declared_charset(content_type, charset):
+    assert parse_worker.declared_charset(content_type) == charset
+
+
+def test_parse_html_rejects_large_pages(monkeypatch):
+    monkeypatch.setattr(parse_worker, "PARSE_MAX_BYTES", 10)
+
+    with pytest.raises(ValueError):
+        asyncio.run(parse_worker.parse_html(PAGE))
+
+
+def test_parse_html_in_pool(pool_state):
+    parsed = asyncio.run(parse_worker.parse_html(PAGE))
+
+    assert parsed["title"] == "Linkbender"
+    assert parse_worker._pool is not None
+
+
+def test_parse_html_without_workers(pool_state, monkeypatch):
+    monkeypatch.setattr(parse_worker, "PARSE_WORKERS", 0)
+
+    parsed = asyncio.run(parse_worker.parse_html(PAGE))
+
+    assert parsed["word_count"] == 5
+    assert parse_worker._pool is None
+
+
+def test_parse_html_falls_back_when_pool_cannot_start(pool_state, monkeypatch):
+    def broken_pool(*args, **kwargs):
+        raise OSError(38, "Function not implemented")
+
+    monkeypatch.setattr(parse_worker, "ProcessPoolExecutor", broken_pool)
+
+    parsed = asyncio.run(parse_worker.parse_html(PAGE))
+
+    assert parsed["word_count"] == 5
+    assert parse_worker._pool_unavailable
+
+
+def test_hung_parse_only_fails_itself(pool_state, monkeypatch, tmp_path):
+    monkeypatch.setattr(parse_worker, "_parse", fake_parse)
+    monkeypatch.setattr(parse_worker, "PARSE_WORKERS", 3)
+    monkeypatch.setattr(parse_worker, "PARSE_TIMEOUT", 60)
+    monkeypatch.setattr(parse_worker, "PARSE_GRACE", 0)
+    hang = str(tmp_path / "hang")
+    healthy = [str(tmp_path / "healthy-1"), str(tmp_path / "healthy-2")]
+
+    async def main():
+        # Park healthy parses on two workers so the kill lands mid-parse
+        others = [
+            asyncio.ensure_future(parse_worker.parse_html(
+                f"wait|{path}|".encode() + PAGE))
+            for path in healthy
+        ]
+        for path in healthy:
+            await wait_for_file(path + ".started")
+
+        # Only the hung parse gets a short timeout, the healthy ones keep a minute
+        monkeypatch.setattr(parse_worker, "PARSE_TIMEOUT", 1)
+        hung = asyncio.ensure_future(
+            parse_worker.parse_html(f"hang|{hang}|".encode()))
+        await asyncio.sleep(0)
+        monkeypatch.setattr(parse_worker, "PARSE_TIMEOUT", 60)
+
+        hung_result = (await asyncio.gather(hung, return_exceptions=True))[0]
+        # Release them once they're back on the new pool
+        for path in healthy:
+            await wait_for_file(path + ".started", "xx")
+            open(path + ".release", "w").close()
+        return hung_result, await asyncio.gather(*others, return_exceptions=True)
+
+    hung, others = asyncio.run(asyncio.wait_for(main(), 120))
+
+    assert isinstance(hung, TimeoutError)
+    assert [parsed["title"] for parsed in others] == [
+        "Linkbender", "Linkbender"]
+    # Each healthy parse ran once, got killed with the pool, then ran again
+    for path in healthy:
+        assert open(path + ".started").read() == "xx"
+
+
+def test_crashing_page_is_not_retried(pool_state, monkeypatch, tmp_path):
+    monkeypatch.setattr(parse_worker, "_parse", fake_parse)
+    crash = str(tmp_path / "crash")
+
+    with pytest.raises(BrokenProcessPool):
+        asyncio.run(parse_worker.parse_html(f"crash|{crash}|".encode()))
+
+    assert open(crash + ".started").read() == "x"
+    assert parse_worker._pool is None
+
+
+def test_parse_html_without_workers_caps_size(pool_state, monkeypatch):
+    monkeypatch.setattr(parse_worker, "PARSE_WORKERS", 0)
+    monkeypatch.setattr(parse_worker, "PARSE_THREAD_MAX_BYTES", 10)
+
+    with pytest.raises(ValueError):
+        asyncio.run(parse_worker.parse_html(PAGE))
+
+
+def test_recycle_ignores_replaced_pool(pool_state):
+    async def main():
+        await parse_worker.parse_html(PAGE)
+        old = parse_worker._pool
+        parse_worker._recycle_pool(old)
+        await parse_worker.parse_html(PAGE)
+        current = parse_worker._pool
+
+        parse_worker._recycle_pool(old)
+        assert parse_worker._pool is current
+        return await parse_worker.parse_html(PAGE)
+
+    assert asyncio.run(main())["title"] == "Linkbender"